@@ -1,76 +1,255 @@
 import argparse
+import base64
+import collections
+import itertools
+import multiprocessing
 import pathlib
-import zbarlight
 import cv2
 import numpy as np
+from concurrent.futures import Executor, ProcessPoolExecutor
 from steganography import Steganography
 from PIL import Image
 from tqdm import tqdm
 
-# Command line options
-parser = argparse.ArgumentParser(
-	description = "Uses QR codes to steganograph binary data in a video file.")
-parser.add_argument("-v", "--video",
-	type = pathlib.Path,
-	required = True,
-	help = "Video containing the encrypted binary file.")
-parser.add_argument("-o", "--output",
-	type = pathlib.Path,
-	required = True,
-	help = "Path to extract the binary file.")
-parser.add_argument("--verbose",
-	action = "store_true",
-	help = "Display informations messages.")
-args = parser.parse_args()
-
-# Set up the input video file
-if not args.video.is_file():
-	raise ErrorVideoFile("[ERROR] The video file does not exist!")
-else:
-	video_file = args.video
-	if args.verbose:
-		print(f"[INFO] We will use the video file: {video_file}.")
-
-# Set up the output binary file
-if args.output.exist() and args.output.samefile(video_file):
-	raise ErrorOutputBinaryFile("[ERROR] The file to use to output the binary datas is the same as the encrypted video file!")
-else:
-	output_binary_file = args.output
-	if args.verbose:
-		print(f"[INFO] We will output the encrypted datas in the file: '{output_binary_file}'.")
-
-# Open the video file
-if args.verbose:
-	print(f"[INFO] Open the video file…")
-
-video_cap = cv2.VideoCapture(str(video_file))
-
-# Set up the binary data buffer
-binary_data = ""
-
-# Loop through each frame of the video
-for i in tqdm(range(int(video_cap.get(cv2.CAP_PROP_FRAME_COUNT)))):
-	# Read the frame
-	success, frame = video_cap.read()
-	if not success:
-		break
+# Use the optimized build of libzbar when it is installed and works with the installed Pillow, as it checks its
+# images with Image.isImageType which Pillow 12 removed
+try:
+	import fastzbarlight as zbarlight
+except ImportError:
+	zbarlight = None
+
+if zbarlight is None or not hasattr(Image, "isImageType"):
+	import zbarlight
+
+class ErrorVideoFile(Exception):
+	"""The video file containing the encrypted binary file does not exist."""
+
+class ErrorOutputBinaryFile(Exception):
+	"""The file where to extract the binary file can not be used."""
+
+# Number of frames sent at once to a worker process
+FRAMES_CHUNK_SIZE = 4
+
+# Number of consecutive frames without QR code after the data that ends it, so a single failed scan in the middle
+# of the data does not cut it short
+END_OF_DATA_EMPTY_FRAMES = 16
+
+# Number of frames read ahead of the frame whose QR code is being collected, whatever the number of workers
+FRAMES_PREFETCH = 64
+
+def read_frames(video_cap: cv2.VideoCapture):
+	"""Reads the frames of a video file.
+
+	Parameters
+	----------
+	video_cap : cv2.VideoCapture
+		The opened video file.
+
+	Yields
+	------
+	np.ndarray
+		The next frame of the video.
+	"""
+
+	while True:
+		success, frame = video_cap.read()
+		if not success:
+			break
+
+		yield frame
+
+def scan_qr_code_in_frame(frame: np.ndarray) -> list | None:
+	"""Scans the QR code hidden in a video frame.
+
+	Parameters
+	----------
+	frame : np.ndarray
+		The video frame to scan.
+
+	Returns
+	-------
+	list | None
+		The data of the QR codes detected in the frame, or None if there is none.
+	"""
 
 	# Extract the QR code from the frame
 	qr_code_image_pil = Steganography().unmerge(frame)
 
+	# Convert the QR code to grayscale with OpenCV, as zbarlight would otherwise do it with PIL
+	qr_code_gray = cv2.cvtColor(np.asarray(qr_code_image_pil), cv2.COLOR_RGB2GRAY)
+
 	# Detect QR codes in the frame
-	qr_code_data = zbarlight.scan_codes("qrcode", qr_code_image_pil)
+	return zbarlight.scan_codes("qrcode", Image.fromarray(qr_code_gray))
+
+def scan_qr_code_in_frame_batch(frames: list) -> list:
+	"""Scans the QR codes hidden in a batch of video frames.
+
+	Parameters
+	----------
+	frames : list[np.ndarray]
+		The video frames to scan.
+
+	Returns
+	-------
+	list[list | None]
+		The data of the QR codes detected in each frame, in the order of the frames.
+	"""
+
+	return [scan_qr_code_in_frame(frame) for frame in frames]
+
+def scan_qr_codes(
+	executor: Executor,
+	frames,
+	max_pending: int
+):
+	"""Scans the QR codes hidden in video frames in parallel, a bounded number of frames ahead.
+
+	Parameters
+	----------
+	executor : concurrent.futures.Executor
+		The pool of workers scanning the frames.
+	frames : Iterable[np.ndarray]
+		The video frames to scan.
+	max_pending : int
+		The maximum number of batches of frames scanned ahead.
+
+	Yields
+	------
+	list | None
+		The data of the QR codes detected in the next frame, in the order of the frames.
+	"""
+
+	pending = collections.deque()
+
+	try:
+		# Send the frames to the workers by batches, while the next frames are decoded
+		while batch := list(itertools.islice(frames, FRAMES_CHUNK_SIZE)):
+			pending.append(executor.submit(scan_qr_code_in_frame_batch, batch))
+			if len(pending) >= max_pending:
+				yield from pending.popleft().result()
+
+		while pending:
+			yield from pending.popleft().result()
+	finally:
+		# Do not scan the frames left when the caller stops early
+		for future in pending:
+			future.cancel()
+
+def extract_binary_from_video(
+	video_file: pathlib.Path,
+	output_binary_file: pathlib.Path,
+	verbose: bool = True
+):
+	"""Extracts the binary file hidden in the QR codes of a video file.
+
+	Parameters
+	----------
+	video_file : pathlib.Path
+		The path to the video file containing the encrypted binary file.
+	output_binary_file : pathlib.Path
+		The path to the file where to extract the binary file.
+	verbose : bool
+		Display informations messages.
+	"""
+
+	# Open the video file
+	if verbose:
+		print(f"[INFO] Open the video file…")
+
+	video_cap = cv2.VideoCapture(str(video_file))
+	num_frames = int(video_cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+	# Set up the list of the binary data chunks, joined once at the end
+	binary_data = []
+
+	# Scan the frames of the video in parallel, with a fixed number of frames in flight to bound the memory usage
+	if verbose:
+		print("[INFO] Scan the frames of the video…")
+
+	# Start the workers from a fork server, as forking this process would copy the threads of the video decoder
+	# (where there is no fork server, the workers are spawned, which is just as safe)
+	if "forkserver" in multiprocessing.get_all_start_methods():
+		mp_context = multiprocessing.get_context("forkserver")
+	else:
+		mp_context = None
+
+	with ProcessPoolExecutor(mp_context = mp_context) as executor:
+		qr_codes_data = scan_qr_codes(
+			executor,
+			read_frames(video_cap),
+			FRAMES_PREFETCH // FRAMES_CHUNK_SIZE
+		)
+
+		empty_frames = 0
+
+		for qr_code_data in tqdm(qr_codes_data, total = num_frames):
+			# If a QR code was detected, keep its chunk of the Base 32 data
+			if qr_code_data is not None:
+				# The QR codes are in consecutive frames, so the frames without one before it lost their chunks
+				if binary_data and empty_frames:
+					print(f"[WARNING] No QR code found in {empty_frames} frame(s) in the middle of the data, the binary file will be corrupted!")
+
+				binary_data.append(qr_code_data[0])
+				empty_frames = 0
+
+			# Enough consecutive frames without QR code after them end the data, and the rest of the video does
+			# not have to be decoded
+			elif binary_data:
+				empty_frames += 1
+				if empty_frames >= END_OF_DATA_EMPTY_FRAMES:
+					break
+
+		# Cancel the frames still waiting to be scanned, before the workers are shut down
+		qr_codes_data.close()
+
+	# Decode the binary data from Base 32, with the padding stripped from the QR codes, and write it to the
+	# output file
+	base32_data = b"".join(binary_data)
+	with open(output_binary_file, "wb") as f:
+		f.write(base64.b32decode(base32_data + b"=" * (-len(base32_data) % 8)))
+
+	# Release the video file
+	if verbose:
+		print("[INFO] Release the video file…")
+
+	video_cap.release()
 
-	# If a QR code was detected, extract the steganographed binary data
-	if qr_code_data is not None:
-		binary_data += steg.extract_binary_data(qr_code_data)
+if __name__ == "__main__":
+	# Command line options
+	parser = argparse.ArgumentParser(
+		description = "Uses QR codes to steganograph binary data in a video file.")
+	parser.add_argument("-v", "--video",
+		type = pathlib.Path,
+		required = True,
+		help = "Video containing the encrypted binary file.")
+	parser.add_argument("-o", "--output",
+		type = pathlib.Path,
+		required = True,
+		help = "Path to extract the binary file.")
+	parser.add_argument("--verbose",
+		action = "store_true",
+		help = "Display informations messages.")
+	args = parser.parse_args()
 
-# Write the binary data to the output file
-with open(output_binary_file, "wb") as f:
-	f.write(binary_data.encode())
+	# Set up the input video file
+	if not args.video.is_file():
+		raise ErrorVideoFile("[ERROR] The video file does not exist!")
+	else:
+		video_file = args.video
+		if args.verbose:
+			print(f"[INFO] We will use the video file: {video_file}.")
 
-# Release the video file
-if args.verbose:
-	print("[INFO] Release the video file…")
+	# Set up the output binary file
+	if args.output.exists() and args.output.samefile(video_file):
+		raise ErrorOutputBinaryFile("[ERROR] The file to use to output the binary datas is the same as the encrypted video file!")
+	else:
+		output_binary_file = args.output
+		if args.verbose:
+			print(f"[INFO] We will output the encrypted datas in the file: '{output_binary_file}'.")
 
-video_cap.release()
\ No newline at end of file
+	# Extract the binary file from the video file
+	extract_binary_from_video(
+		video_file,
+		output_binary_file,
+		args.verbose
+	)
\ No newline at end of file
@@ -1,36 +1,313 @@
 import argparse
-import tempfile
+import base64
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
 import pathlib
 import cv2
 import qrcode
-import base64
 import numpy
 import subprocess
 from tqdm import tqdm
-from PIL import Image, ImageEnhance
 
-def encode_binary_in_base64(binary_file) -> bytes:
-	"""Encodes a binary file into Base 64.
+# The size of the pipes can only be changed on Linux
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# Use the JIT compiled blending of the QR codes when Numba is installed
+try:
+	import numba
+except ImportError:
+	numba = None
+
+class ErrorBinaryFile(Exception):
+	"""The binary file to encrypt does not exist."""
+
+class ErrorVideoFile(Exception):
+	"""The video file to use for the encryption does not exist."""
+
+class ErrorOutputVideoFile(Exception):
+	"""The output video file can not be used."""
+
+class ErrorNumFrames(Exception):
+	"""The video file does not have enough frames for all the QR codes."""
+
+class ErrorFrameSize(Exception):
+	"""The frames of the video file are too small for the QR codes."""
+
+class ErrorFFmpeg(Exception):
+	"""The FFmpeg subprocess failed."""
+
+# Opacity of the QR codes embedded in the frames (out of 255)
+QR_CODE_ALPHA = 32
+
+# Number of QR codes encoded by a worker process in a single task
+QR_CODES_BATCH_SIZE = 8
+
+# Number of batches of QR codes encoded ahead of the frames by each worker process
+QR_CODES_PREFETCH = 2
+
+# Number of frames read ahead and written behind the frame being blended
+FRAMES_PREFETCH = 32
+
+# Fraction of the frame count from the video header under which it is trusted without counting the frames
+FRAME_COUNT_TRUST = 0.9
+
+# Size of the buffers of the pipe to FFmpeg
+FFMPEG_PIPE_SIZE = 1 << 20
+
+# FFmpeg arguments of the lossless video encoders to use for the output video (NVENC needs planar RGB to
+# encode in 4:4:4, it subsamples the chroma of packed RGB frames)
+VIDEO_ENCODERS = {
+	"ffv1": ["-c:v", "ffv1", "-level", "3", "-slicecrc", "1"],
+	"libx264rgb": ["-c:v", "libx264rgb", "-preset", "ultrafast", "-qp", "0"],
+	"h264_nvenc": ["-c:v", "h264_nvenc", "-pix_fmt", "gbrp", "-preset", "p1", "-tune", "lossless"],
+	"hevc_nvenc": ["-c:v", "hevc_nvenc", "-pix_fmt", "gbrp", "-preset", "p1", "-tune", "lossless"]
+}
+
+# Version and error correction level of the QR codes
+QR_VERSION = 40
+QR_ERROR_CORRECTION = qrcode.constants.ERROR_CORRECT_M
+
+# Mask pattern of the QR codes, fixed to skip the evaluation of the 8 patterns for each QR code
+QR_MASK_PATTERN = 0
+
+# Number of modules on the side of the QR codes of the version
+QR_CODE_MODULES = 4 * QR_VERSION + 17
+
+# Data bits for QR code of the version, minus the mode indicator and the length of the data in alphanumeric mode
+QR_CODE_DATA_BITS = (
+	qrcode.util.BIT_LIMIT_TABLE[QR_ERROR_CORRECTION][QR_VERSION]
+	- 4
+	- qrcode.util.length_in_bits(qrcode.util.MODE_ALPHA_NUM, QR_VERSION)
+)
+
+# Maximum of characters for QR code of the version in alphanumeric mode (11 bits by pair of characters, 6 bits
+# for a last single one)
+QR_CODE_CAPACITY = QR_CODE_DATA_BITS // 11 * 2 + (QR_CODE_DATA_BITS % 11 >= 6)
+
+# Number of bytes of the binary file by QR code, in whole groups of 5 bytes so the Base 32 of the chunks joins
+# without padding in between
+QR_CODE_BLOCK_SIZE = QR_CODE_CAPACITY // 8 * 5
+
+# QR code reused for every chunk encoded by a process, as its settings never change
+_qr_code = qrcode.QRCode(
+	version = QR_VERSION,
+	error_correction = QR_ERROR_CORRECTION,
+	border = 0,
+	mask_pattern = QR_MASK_PATTERN
+)
+
+def read_binary_chunks(
+	binary_file: pathlib.Path,
+	chunk_size: int
+):
+	"""Reads a binary file chunk by chunk.
 
 	Parameters
 	----------
-	binary_file : bytes
-		Binary file to convert into Base 64.
+	binary_file : pathlib.Path
+		Binary file to read.
+	chunk_size : int
+		The maximum number of bytes by chunk.
 
-	Returns
-	-------
+	Yields
+	------
 	bytes
-		The binary file encoded in Base 64.
+		The next chunk of the binary file.
 	"""
 
 	with binary_file.open('rb') as f:
-		binary_data = f.read()
+		while chunk := f.read(chunk_size):
+			yield chunk
+
+def make_qr_code_matrix(chunk: bytes) -> numpy.ndarray:
+	"""Encodes a chunk of the binary file in Base 32 into the modules of a QR code.
+
+	Parameters
+	----------
+	chunk : bytes
+		The bytes to encode in the QR code.
+
+	Returns
+	-------
+	numpy.ndarray
+		The modules of the QR code packed in bits along the rows (1 for the dark ones).
+	"""
+
+	# Encode the chunk in Base 32, as the QR code scanners convert the bytes they read to text, without the
+	# padding of the last chunk which is not in the alphanumeric characters
+	data = base64.b32encode(chunk).rstrip(b"=")
+
+	# The version of the QR codes is fixed, so the chunks must fit in it
+	assert len(data) <= QR_CODE_CAPACITY
+
+	# Reset the QR code of the process from the previous chunk
+	_qr_code.clear()
+
+	# Store the data in a single segment in alphanumeric mode, which the capacity of the QR codes is computed for
+	_qr_code.add_data(qrcode.util.QRData(data, mode = qrcode.util.MODE_ALPHA_NUM))
+	_qr_code.make(fit = False)
 
-	return base64.b64encode(binary_data)
+	# Pack the modules in bits, to send 8 times less data back to the main process
+	return numpy.packbits(numpy.asarray(_qr_code.get_matrix(), dtype = numpy.uint8), axis = 1)
+
+def make_qr_code_matrix_batch(chunks: list) -> list:
+	"""Encodes a batch of chunks of data into the modules of QR codes.
+
+	Parameters
+	----------
+	chunks : list[bytes]
+		The chunks of bytes to encode in the QR codes.
+
+	Returns
+	-------
+	list[numpy.ndarray]
+		The modules of the QR codes packed in bits along the rows, in the order of the chunks.
+	"""
+
+	return [make_qr_code_matrix(chunk) for chunk in chunks]
+
+def make_qr_code_matrices(
+	executor: concurrent.futures.Executor,
+	chunks,
+	max_pending: int
+):
+	"""Encodes chunks of data into QR codes in parallel, a bounded number of chunks ahead.
+
+	Parameters
+	----------
+	executor : concurrent.futures.Executor
+		The pool of workers encoding the QR codes.
+	chunks : Iterable[bytes]
+		The chunks of data to encode in the QR codes.
+	max_pending : int
+		The maximum number of batches of QR codes encoded ahead.
+
+	Yields
+	------
+	numpy.ndarray
+		The packed modules of the next QR code, in the order of the chunks.
+	"""
+
+	pending = collections.deque()
+	chunks = iter(chunks)
+
+	# Send the chunks to the workers by batches, to spread the cost of the inter-process communication
+	while batch := list(itertools.islice(chunks, QR_CODES_BATCH_SIZE)):
+		pending.append(executor.submit(make_qr_code_matrix_batch, batch))
+		if len(pending) >= max_pending:
+			yield from pending.popleft().result()
+
+	while pending:
+		yield from pending.popleft().result()
+
+def read_frames(
+	executor: concurrent.futures.Executor,
+	video_cap: cv2.VideoCapture,
+	num_frames: int,
+	max_pending: int
+):
+	"""Reads the first frames of a video in a background thread, a bounded number of frames ahead.
+
+	Parameters
+	----------
+	executor : concurrent.futures.Executor
+		The single thread reading the frames.
+	video_cap : cv2.VideoCapture
+		The opened video file.
+	num_frames : int
+		The number of frames to read.
+	max_pending : int
+		The maximum number of frames read ahead.
+
+	Yields
+	------
+	numpy.ndarray
+		The next frame of the video.
+	"""
+
+	pending = collections.deque()
+
+	for _ in range(num_frames):
+		pending.append(executor.submit(video_cap.read))
+		if len(pending) >= max_pending:
+			success, frame = pending.popleft().result()
+			if not success:
+				return
+
+			yield frame
+
+	while pending:
+		success, frame = pending.popleft().result()
+		if not success:
+			return
+
+		yield frame
+
+def render_qr_code_tile(
+	qr_code_matrix: numpy.ndarray,
+	module_size: int
+) -> numpy.ndarray:
+	"""Renders a QR code into an image ready to be embedded in the video frames.
+
+	Parameters
+	----------
+	qr_code_matrix : numpy.ndarray
+		The modules of the QR code to render packed in bits along the rows (1 for the dark ones).
+	module_size : int
+		The side, in pixels, of each module of the QR code.
+
+	Returns
+	-------
+	numpy.ndarray
+		The grayscale image of the QR code, already scaled by its opacity.
+	"""
+
+	# Unpack the modules of the square QR code
+	qr_code_modules = qr_code_matrix.shape[0]
+	qr_code_matrix = numpy.unpackbits(qr_code_matrix, axis = 1, count = qr_code_modules)
+
+	# Upscale each module to a square of pixels, black for the dark ones and white scaled by the opacity
+	# for the light ones
+	qr_code_side = qr_code_modules * module_size
+	return cv2.resize(
+		(1 - qr_code_matrix) * QR_CODE_ALPHA,
+		(qr_code_side, qr_code_side),
+		interpolation = cv2.INTER_NEAREST
+	)
+
+if numba is not None:
+	# Not parallel, the QR code worker processes and FFmpeg already use all the cores
+	@numba.njit(fastmath = True, cache = True)
+	def blend_qr_code_tile(
+		roi: numpy.ndarray,
+		qr_code_tile: numpy.ndarray
+	):
+		"""Blends a QR code in a region of a video frame, in place, in a single pass.
+
+		Parameters
+		----------
+		roi : numpy.ndarray
+			The region of the video frame to embed the QR code in.
+		qr_code_tile : numpy.ndarray
+			The rendered grayscale QR code, scaled by its opacity.
+		"""
+
+		# Same rounding as cv2.convertScaleAbs, the frame can never be exactly half-way between two values
+		for y in range(roi.shape[0]):
+			for x in range(roi.shape[1]):
+				for c in range(roi.shape[2]):
+					roi[y, x, c] = (roi[y, x, c] * (255 - QR_CODE_ALPHA) + 127) // 255 + qr_code_tile[y, x]
 
 def embed_qr_code_in_frame(
 	frame: numpy.ndarray,
-	qr_code: qrcode.main.QRCode
+	qr_code_tile: numpy.ndarray,
+	qr_code_region: tuple
 ) -> numpy.ndarray:
 	"""Embeds a QR code in a video frame.
 
@@ -38,8 +315,10 @@ def embed_qr_code_in_frame(
 	----------
 	frame : numpy.ndarray
 		The video frame to embed the QR code in.
-	qr_code : qrcode.main.QRCode
-		The bytes of the QR code to embed in the video frame.
+	qr_code_tile : numpy.ndarray
+		The rendered grayscale QR code to embed in the video frame, scaled by its opacity.
+	qr_code_region : tuple[slice, slice]
+		The rows and the columns of the frame where to embed the QR code.
 
 	Returns
 	-------
@@ -47,56 +326,60 @@ def embed_qr_code_in_frame(
 		The frame to add to the output video.
 	"""
 
-	# Convert the QR code bytes to a QR code image
-	qr_code_image = qr_code.make_image(
-		fill_color = "black",
-		back_color = "white"
-	)
-
-	# Create the QR code to hide in the frame
-	qr_code_image_pil = qr_code_image.convert("RGBA")
-
-	# Set the alpha channel of the QR code to 25%
-	qr_code_image_pil.putalpha(32)
-
-	# Get the dimensions of the frame
-	frame_height, frame_width, _ = frame.shape
-
-	# Resize the QR code to fit the frame
-	if frame_width > frame_height:
-		qr_code_image_pil = qr_code_image_pil.resize((frame_height, frame_height), Image.Resampling.LANCZOS)
+	# Blend the QR code in its region of the frame, in place: scale the frame by the opacity left over by
+	# the QR code, then add the QR code (the sum can not overflow 255)
+	roi = frame[qr_code_region]
+	if numba is not None:
+		blend_qr_code_tile(roi, qr_code_tile)
 	else:
-		qr_code_image_pil = qr_code_image_pil.resize((frame_width, frame_width), Image.Resampling.LANCZOS)
-
-	# Calculate the center of the frame
-	center = (frame_width // 2 - qr_code_image_pil.width // 2, frame_height // 2 - qr_code_image_pil.height // 2)
-
-	# Convert the frame to a PIL image
-	frame_pil = Image.fromarray(frame)
-
-	# Paste the QR code image in the middle of the frame image
-	frame_pil.paste(qr_code_image_pil, center, qr_code_image_pil)
+		cv2.convertScaleAbs(roi, dst = roi, alpha = 1 - QR_CODE_ALPHA / 255)
+		numpy.add(roi, qr_code_tile[..., None], out = roi)
 
-	return numpy.array(frame_pil)
+	return frame
 
-def copy_audio_and_metadata_to_output(
+def open_output_video(
 	video_file: pathlib.Path,
-	temp_video_file: pathlib.Path,
 	output_video_file: pathlib.Path,
+	frame_width: int,
+	frame_height: int,
+	fps: float,
+	sample_aspect_ratio: str,
+	num_head_frames: int,
+	video_encoder: str = "ffv1",
 	verbose: bool = True
-):
-	"""Copy the audio tracks, subtitles, and metadata from a video file to the Matroska output video.
+) -> subprocess.Popen:
+	"""Starts the FFmpeg subprocess writing the Matroska output video.
+
+	The raw BGR frames written to its standard input replace the first frames of the source video, and
+	FFmpeg decodes the remaining frames from the source video file itself. The video is encoded losslessly,
+	so the QR codes survive the encoding, and the audio tracks and metadata are copied from the source video
+	file.
 
 	Parameters
 	----------
 	video_file : pathlib.Path
 		The path to the video file to use for embedding QR codes.
-	temp_video_file : pathlib.Path
-		The path to the temporary video file.
 	output_video_file : pathlib.Path
 		The path to the output video file where to save the encrypted version.
+	frame_width : int
+		The width of the frames.
+	frame_height : int
+		The height of the frames.
+	fps : float
+		The frame rate of the video.
+	sample_aspect_ratio : str
+		The sample aspect ratio of the source video, as "num/den".
+	num_head_frames : int
+		The number of frames written to the standard input of FFmpeg.
+	video_encoder : str
+		The lossless video encoder to use, one of VIDEO_ENCODERS.
 	verbose : bool
 		Display informations messages.
+
+	Returns
+	-------
+	subprocess.Popen
+		The FFmpeg subprocess.
 	"""
 
 	# Create the FFmpeg command
@@ -104,36 +387,107 @@ def copy_audio_and_metadata_to_output(
 		print("[INFO] Create the FFmpeg command…")
 	command = [
 		"ffmpeg",
+		"-filter_threads", str(os.cpu_count() or 1),
+		"-f", "rawvideo",
+		"-pix_fmt", "bgr24",
+		"-s", f"{frame_width}x{frame_height}",
+		"-framerate", str(fps),
+		"-i", "pipe:",
+		"-fflags", "+genpts",
 		"-i", str(video_file),
-		"-i", str(temp_video_file),
-		"-c", "copy",
-		"-map", "1:v",
-		"-map", "0:a",
-		"-map_metadata", "0",
+		"-filter_complex", (
+			f"[0:v]setsar={sample_aspect_ratio}[head];"
+			f"[1:v:0]trim=start_frame={num_head_frames},setpts=PTS-STARTPTS[tail];"
+			"[head][tail]concat=n=2:v=1:a=0[video]"
+		),
+		"-map", "[video]",
+		"-map", "1:a?",
+		"-map_metadata", "1",
+		*VIDEO_ENCODERS[video_encoder],
+		"-threads", "0",
+		"-c:a", "copy",
 		"-y",
 		str(output_video_file)
 	]
 
 	# Start the FFmpeg subprocess
-	try:
-		if verbose:
-			print("[INFO] Start the FFmpeg subprocess…")
-		subprocess.run(command, check = True)
-		if verbose:
-			print("[INFO] The FFmpeg subprocess was successful.")
-	except subprocess.CalledProcessError as e:
-		print(f"[ERROR] FFmpeg error: {e.stderr()}")
+	if verbose:
+		print("[INFO] Start the FFmpeg subprocess…")
+
+	ffmpeg_process = subprocess.Popen(
+		command,
+		stdin = subprocess.PIPE,
+		bufsize = FFMPEG_PIPE_SIZE
+	)
+
+	# Enlarge the kernel buffer of the pipe (64 KiB by default), to need fewer wake-ups of FFmpeg per frame
+	if hasattr(fcntl, "F_SETPIPE_SZ"):
+		try:
+			fcntl.fcntl(ffmpeg_process.stdin.fileno(), fcntl.F_SETPIPE_SZ, FFMPEG_PIPE_SIZE)
+		except OSError:
+			# The size is above the limit of /proc/sys/fs/pipe-max-size
+			pass
+
+	return ffmpeg_process
+
+def close_output_video(
+	ffmpeg_process: subprocess.Popen,
+	verbose: bool = True
+):
+	"""Waits for the FFmpeg subprocess writing the output video to finish.
+
+	Parameters
+	----------
+	ffmpeg_process : subprocess.Popen
+		The FFmpeg subprocess.
+	verbose : bool
+		Display informations messages.
+	"""
+
+	# Signal the end of the frames to FFmpeg
+	ffmpeg_process.stdin.close()
+
+	# Wait for FFmpeg to encode the last frames
+	if ffmpeg_process.wait() != 0:
 		raise ErrorFFmpeg("[ERROR] The FFmpeg subprocess failed!")
 
-	# Remove the temporary video
 	if verbose:
-		print("[INFO] Remove the temporary video…")
-	temp_video_file.unlink()
+		print("[INFO] The FFmpeg subprocess was successful.")
+
+def count_video_frames(
+	video_file: pathlib.Path
+) -> int:
+	"""Counts the exact number of frames of a video file with FFprobe.
+
+	Parameters
+	----------
+	video_file : pathlib.Path
+		The path to the video file.
+
+	Returns
+	-------
+	int
+		The number of frames of the first video stream.
+	"""
+
+	# Count the packets of the first video stream, without decoding them
+	output = subprocess.check_output([
+		"ffprobe",
+		"-v", "error",
+		"-select_streams", "v:0",
+		"-count_packets",
+		"-show_entries", "stream=nb_read_packets",
+		"-of", "csv=p=0",
+		str(video_file)
+	])
+
+	return int(output)
 
 def embed_qr_codes_in_video(
 	video_file: pathlib.Path,
 	binary_file: pathlib.Path,
 	output_video_file: pathlib.Path,
+	video_encoder: str = "ffv1",
 	verbose: bool = True
 ):
 	"""Embeds QR codes in a video file.
@@ -146,6 +500,8 @@ def embed_qr_codes_in_video(
 		The binary file to encrypt in the video file.
 	output_video_file : pathlib.Path
 		The path to the output video file where to save the encrypted version.
+	video_encoder : str
+		The lossless video encoder to use, one of VIDEO_ENCODERS.
 	verbose : bool
 		Display informations messages.
 	"""
@@ -156,120 +512,136 @@ def embed_qr_codes_in_video(
 	video_cap = cv2.VideoCapture(str(video_file))
 	frame_width = int(video_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
 	frame_height = int(video_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-	fps = int(video_cap.get(cv2.CAP_PROP_FPS))
+	fps = video_cap.get(cv2.CAP_PROP_FPS)
 
-	# Get the number of frames in the video
-	if verbose:
-		print("[INFO] Get the number of frames in the video…")
-	num_frames = int(video_cap.get(cv2.CAP_PROP_FRAME_COUNT))
-	if args.verbose:
-		print(f"[INFO] There is {num_frames} frames in the video.")
-
-	# Encode the binary file into Base 64
-	if verbose:
-		print("[INFO] Encode the binary file into Base 64…")
-	base64_file = encode_binary_in_base64(binary_file)
+	# Keep the sample aspect ratio of the source video for the frames with the QR codes (0/1 when unknown,
+	# like FFmpeg)
+	sample_aspect_ratio = f"{int(video_cap.get(cv2.CAP_PROP_SAR_NUM))}/{int(video_cap.get(cv2.CAP_PROP_SAR_DEN)) or 1}"
 
-	# Set up the QR code size and error correction level
+	# Read the binary file while the QR codes are made
+	chunk_size = QR_CODE_BLOCK_SIZE
 	if verbose:
-		print("[INFO] Set up the QR code size and error correction level…")
+		print(f"[INFO] They can be {chunk_size} bytes by QR code, encoded in Base 32.")
+	chunks = read_binary_chunks(binary_file, chunk_size)
 
-	qr_version = 40
-	qr_error_correction = qrcode.constants.ERROR_CORRECT_M
-
-	# Maximum of characters for QR code of the version
-	chunk_size = qrcode.make(
-		"Test",
-		version = qr_version,
-		border = 0,
-		error_correction = qr_error_correction
-	).size[0] - 1
+	# Get the number of QR codes from the size of the binary file
+	num_qr_codes = -(-binary_file.stat().st_size // chunk_size)
 
+	# Get the number of frames in the video, from its header when the QR codes need far fewer frames
 	if verbose:
-		print(f"[INFO] They can be {chunk_size} ASCII characters by QR code.")
-
-	# Convert the binary data into a list of QR codes
+		print("[INFO] Get the number of frames in the video…")
+	num_frames = int(video_cap.get(cv2.CAP_PROP_FRAME_COUNT))
+	if num_qr_codes > num_frames * FRAME_COUNT_TRUST:
+		if verbose:
+			print("[INFO] Count the exact number of frames in the video…")
+		num_frames = count_video_frames(video_file)
 	if verbose:
-		print("[INFO] Convert the binary data into a list of QR codes…")
-
-	# Create a list to store the QR codes
-	qr_codes = []
-
-	for i in tqdm(range(0, len(base64_file), chunk_size)):
-		chunk = base64_file[i:i + chunk_size]
-		qr_code = qrcode.QRCode(
-			version = qr_version,
-			error_correction = qr_error_correction,
-			border = 0
-		)
-		qr_code.add_data(chunk)
-		qr_code.make(fit = True)
-		qr_codes.append(qr_code)
+		print(f"[INFO] There is {num_frames} frames in the video.")
 
 	# Check if there is enought frames in the video for all the QR codes
-	if len(qr_codes) > num_frames:
+	if num_qr_codes > num_frames:
 		raise ErrorNumFrames("[ERROR] There is not enought frames in the video for all the file!")
 
-	# Create the codec to save the video in the same format as the original
-	if verbose:
-		print("[INFO] Create the codec to save the video in the same format as the original…")
-	fourcc = int(video_cap.get(cv2.CAP_PROP_FOURCC))
+	# Get the biggest size of the QR code modules for the QR codes to fit in the frames
+	module_size = min(frame_width, frame_height) // QR_CODE_MODULES
+	if module_size == 0:
+		raise ErrorFrameSize("[ERROR] The frames of the video are too small for the QR codes!")
 
-	# Create a temporary file with a specific extension
-	if verbose:
-		print("[INFO] Create a temporary file with a specific extension…")
-	temp_output = tempfile.NamedTemporaryFile(
-		suffix = ".mp4",
-		delete = False
-	)
+	# Calculate the region in the middle of the frames where to embed the QR codes
+	qr_code_side = module_size * QR_CODE_MODULES
+	x = frame_width // 2 - qr_code_side // 2
+	y = frame_height // 2 - qr_code_side // 2
+	qr_code_region = (slice(y, y + qr_code_side), slice(x, x + qr_code_side))
 
-	# Get the path to the temporary file
-	if verbose:
-		print("[INFO] Get the path to the temporary file…")
-	temp_output_path = pathlib.Path(temp_output.name)
-
-	if verbose:
-		print(f"[INFO] The path to the temporary file is: '{temp_output_path}'.")
-
-	# Create the temporary output video
-	video_out = cv2.VideoWriter(
-		str(temp_output_path),
-		fourcc,
+	# Create the output video
+	ffmpeg_process = open_output_video(
+		video_file,
+		output_video_file,
+		frame_width,
+		frame_height,
 		fps,
-		(frame_width, frame_height),
-		True
+		sample_aspect_ratio,
+		num_qr_codes,
+		video_encoder,
+		verbose
 	)
 
-	# Embed the QR codes in the video frames
-	if verbose:
-		print("[INFO] Embed the QR codes in the video frames…")
+	# Never leave FFmpeg running after an error, it would take the end of its input for the end of the frames
+	# and encode the rest of the source video behind the QR codes embedded so far
+	try:
+		# Embed the QR codes in the video frames
+		if verbose:
+			print("[INFO] Embed the QR codes in the video frames…")
 
-	for i in tqdm(range(num_frames)):
-		# Read in the next frame of the video
-		success, frame = video_cap.read()
-		if not success:
-			break
+		# Convert the binary data into QR codes in worker processes, while the frames are embedded
+		if verbose:
+			print("[INFO] Convert the binary data into QR codes…")
+
+		num_workers = os.cpu_count() or 1
 
-		if i < len(qr_codes):
-			modified_frame = embed_qr_code_in_frame(frame, qr_codes[i])
-			video_out.write(modified_frame)
+		# Start the workers from a fork server, as forking this process would copy the threads decoding the video
+		# and the pipe to FFmpeg (where there is no fork server, the workers are spawned, which is just as safe)
+		if "forkserver" in multiprocessing.get_all_start_methods():
+			mp_context = multiprocessing.get_context("forkserver")
 		else:
-			video_out.write(frame)
+			mp_context = None
+
+		# Read and write the frames in their own threads, while the main thread blends them
+		with (
+			concurrent.futures.ProcessPoolExecutor(max_workers = num_workers, mp_context = mp_context) as executor,
+			concurrent.futures.ThreadPoolExecutor(max_workers = 1) as reader,
+			concurrent.futures.ThreadPoolExecutor(max_workers = 1) as writer
+		):
+			qr_code_matrices = make_qr_code_matrices(
+				executor,
+				chunks,
+				QR_CODES_PREFETCH * num_workers
+			)
+
+			# Render each QR code once, at the size of the frames, right before it is embedded
+			qr_code_tiles = (render_qr_code_tile(qr_code_matrix, module_size) for qr_code_matrix in qr_code_matrices)
+
+			# Only the frames with a QR code go through Python, FFmpeg takes the rest from the source video
+			frames = read_frames(reader, video_cap, num_qr_codes, FRAMES_PREFETCH)
+			pending_writes = collections.deque()
+			num_embedded = 0
+
+			for frame, qr_code_tile in zip(frames, tqdm(qr_code_tiles, total = num_qr_codes)):
+				num_embedded += 1
+				frame = embed_qr_code_in_frame(frame, qr_code_tile, qr_code_region)
+
+				# Write the frame to FFmpeg in the background, a bounded number of frames behind,
+				# straight from its buffer (each frame read is a new contiguous array, never reused)
+				pending_writes.append(writer.submit(ffmpeg_process.stdin.write, frame.data))
+				if len(pending_writes) >= FRAMES_PREFETCH:
+					pending_writes.popleft().result()
+
+			# Wait for the last frames to be written
+			while pending_writes:
+				pending_writes.popleft().result()
+
+		# Close the video files
+		if verbose:
+			print("[INFO] Close the video files…")
 
-	# Close the video files
-	if verbose:
-		print("[INFO] Close the video files…")
+		video_cap.release()
 
-	video_cap.release()
-	video_out.release()
+		# Check that the video really had a frame for each QR code
+		if num_embedded < num_qr_codes:
+			raise ErrorNumFrames("[ERROR] There is not enought frames in the video for all the file!")
 
-	# Copy the rest of the source video to the output video
-	copy_audio_and_metadata_to_output(
-		video_file,
-		temp_output_path,
-		output_video_file,
-		verbose
-	)
+		close_output_video(ffmpeg_process, verbose)
+	except BaseException as error:
+		video_cap.release()
+		ffmpeg_process.kill()
+		ffmpeg_process.wait()
+		output_video_file.unlink(missing_ok = True)
+
+		# FFmpeg stopped reading the frames, for example when the video encoder can not start
+		if isinstance(error, BrokenPipeError):
+			raise ErrorFFmpeg("[ERROR] The FFmpeg subprocess stopped reading the frames!") from error
+
+		raise
 
 if __name__ == "__main__":
 	# Command line options
@@ -286,7 +658,11 @@ if __name__ == "__main__":
 	parser.add_argument("-o", "--output",
 		type = pathlib.Path,
 		required = True,
-		help = "Video file where to save the encrypted version.")
+		help = "Video file where to save the encrypted version (must be a Matroska Multimedia Container).")
+	parser.add_argument("-e", "--encoder",
+		choices = VIDEO_ENCODERS,
+		default = "ffv1",
+		help = "Lossless video encoder to use, the NVENC ones need an NVIDIA GPU (default: ffv1).")
 	parser.add_argument("--verbose",
 		action = "store_true",
 		help = "Display informations messages.")
@@ -309,6 +685,8 @@ if __name__ == "__main__":
 
 	if args.output.exists() and args.output.samefile(video_file):
 		raise ErrorOutputVideoFile("[ERROR] The video to use for encryption is the same as the output video!")
+	elif args.output.suffix.lower() != ".mkv":
+		raise ErrorOutputVideoFile("[ERROR] The output video must be a Matroska Multimedia Container (.mkv)!")
 	else:
 		output_video_file = args.output
 
@@ -320,6 +698,7 @@ if __name__ == "__main__":
 		video_file,
 		binary_file,
 		output_video_file,
+		args.encoder,
 		args.verbose
 	)
 